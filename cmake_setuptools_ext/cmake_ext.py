@@ -1,14 +1,20 @@
 import os
 import sys
 import subprocess
-import multiprocessing
 import shutil
-import glob
-from typing import Callable
+import shlex
+import re
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Pattern, Union
 
 from setuptools import Extension
 from setuptools.command.build_ext import build_ext
 
+# cgroup (v2) file with the cpu quota of the current process
+_CGROUP_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+
 
 def auto_determine_jobs() -> int:
     """Auto-determine number of jobs to use for cmake build
@@ -16,10 +22,260 @@ def auto_determine_jobs() -> int:
     Returns
     -------
     int
-        cpu count, returns number of jobs as max(min(int(cpu_count/2), 8),1)
+        number of cpus available to the current process, taking into account the cpu affinity and
+        cgroup (v2) cpu quota (e.g. the cpu limit of a container)
+    """
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count() or 1
+    # limit to the cgroup cpu quota if there is one
+    try:
+        with open(_CGROUP_CPU_MAX, "r") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpu_count = min(cpu_count, max(int(quota) // int(period), 1))
+    except (OSError, ValueError):
+        pass
+    return max(cpu_count, 1)
+
+
+def _env_flag(name: str) -> bool:
+    """Check whether a boolean environment variable is set to a true value
+
+    Parameters
+    ----------
+    name : str
+        name of environment variable
+
+    Returns
+    -------
+    bool
+        True if the variable is set to one of 1, true, yes or on (case insensitive)
+    """
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _fast_rmtree(path: str):
+    """Remove a directory tree using rm -rf
+
+    This is much faster than shutil.rmtree for large cmake build trees. On Windows, or if rm
+    is not available, shutil.rmtree is used (going through cmd for rd would require quoting
+    cmd metacharacters in the path). Nothing is done if the path does not exist.
+
+    Parameters
+    ----------
+    path : str
+        path to directory to remove
+    """
+    if not os.path.lexists(path):
+        return
+    if os.name == "nt":
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    try:
+        subprocess.run(["rm", "-rf", path], check=False)
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _copy_file_range(src: str, dst: str):
+    """Copy a file with os.copy_file_range, which lets the kernel copy (or reflink) the data
+
+    Parameters
+    ----------
+    src : str
+        path to source file
+    dst : str
+        path to destination file
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                # e.g. filesystems that don't support it or a source that shrank, don't leave a truncated copy
+                raise OSError("os.copy_file_range copied fewer bytes than the size of {}".format(src))
+            remaining -= copied
+
+
+def _fast_link(src: str, dst: str):
+    """Place a file at dst with the same contents as src, as cheaply as possible
+
+    Tries a hardlink first, then os.copy_file_range (if available), and finally
+    falls back to shutil.copyfile. The file mode of src is kept.
+
+    Parameters
+    ----------
+    src : str
+        path to source file
+    dst : str
+        path to destination file
+    """
+    # resolve symlinks so the contents are linked/copied rather than the link itself
+    src = os.path.realpath(src)
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        if not hasattr(os, "copy_file_range"):
+            raise OSError("os.copy_file_range not available")
+        _copy_file_range(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+
+
+def _copy_symlink(target: str, dst: str) -> bool:
+    """Create a symlink at dst pointing to target, replacing any existing file
+
+    Parameters
+    ----------
+    target : str
+        target of the symlink
+    dst : str
+        path of the symlink to create
+
+    Returns
+    -------
+    bool
+        True if the symlink was created, False if the platform does not allow it
     """
-    cpu_count = multiprocessing.cpu_count()
-    return max([min([int(cpu_count / 2), 8]), 1])
+    if os.path.islink(dst) and os.readlink(dst) == target:
+        return True
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.symlink(target, dst)
+    except OSError:
+        return False
+    return True
+
+
+def _include_all(name: str) -> bool:
+    return True
+
+
+def _exclude_none(name: str) -> bool:
+    return False
+
+
+# minimum free space required to build in a tmpfs
+_TMPFS_MIN_FREE = 1 << 30
+
+
+def _make_tmpfs_directory() -> str:
+    """Make a temporary build directory on a RAM backed filesystem
+
+    Returns
+    -------
+    str
+        path to the created directory, or None if no tmpfs with enough free space is available
+    """
+    if not sys.platform.startswith("linux") or not os.path.isdir("/dev/shm"):
+        return None
+    try:
+        if shutil.disk_usage("/dev/shm").free < _TMPFS_MIN_FREE:
+            return None
+        return tempfile.mkdtemp(prefix="cmake_setuptools_ext-", dir="/dev/shm")
+    except OSError:
+        return None
+
+
+def _has_cmake_define(cmake_args: List[str], name: str) -> bool:
+    """Check whether a cache variable is defined in a list of cmake arguments
+
+    Both the `-DNAME=value` and `-D NAME=value` forms (with an optional `:TYPE`) are detected.
+
+    Parameters
+    ----------
+    cmake_args : List[str]
+        arguments passed to the cmake configure step
+    name : str
+        name of the cache variable
+
+    Returns
+    -------
+    bool
+        True if the variable is defined in cmake_args
+    """
+    for i, arg in enumerate(cmake_args):
+        # join the spaced form, e.g. ["-D", "NAME=value"]
+        if arg == "-D" and i + 1 < len(cmake_args):
+            arg = "-D" + cmake_args[i + 1]
+        if arg.startswith("-D" + name) and arg[len(name) + 2 : len(name) + 3] in ("", "=", ":"):
+            return True
+    return False
+
+
+# name of the stamp file written to the build directory after a successful build
+_STAMP_FILE = ".cmake_setuptools_ext_stamp"
+
+# environment variables read by the cmake configure step, which are part of the build stamp
+# (in addition to any CMAKE_<LANG>_COMPILER_LAUNCHER variables)
+_STAMP_ENV_VARS = [
+    "CC",
+    "CXX",
+    "CFLAGS",
+    "CXXFLAGS",
+    "LDFLAGS",
+    "CMAKE_BUILD_TYPE",
+    "CMAKE_GENERATOR",
+    "CMAKE_TOOLCHAIN_FILE",
+]
+
+
+def _build_stamp(ext: "CMakeExtension", cmake_args: List[str]) -> str:
+    """Compute a stamp identifying the configuration of a cmake build
+
+    Parameters
+    ----------
+    ext : CMakeExtension
+        extension being built
+    cmake_args : List[str]
+        arguments passed to the cmake configure step
+
+    Returns
+    -------
+    str
+        hash of the cmakelists path, cmake arguments, configure environment variables and toolchain
+        modification time on the first line, and the modification time of the cmakelists on the second line
+    """
+    env_vars = _STAMP_ENV_VARS + sorted(
+        var for var in os.environ if var.startswith("CMAKE_") and var.endswith("_COMPILER_LAUNCHER")
+    )
+    key = [os.path.abspath(ext.cmakelists)] + cmake_args
+    key += ["{}={}".format(var, os.environ[var]) for var in env_vars if var in os.environ]
+    if ext.toolchain:
+        key += ["toolchain={}".format(os.path.getmtime(ext.toolchain))]
+    key = "\n".join(key)
+    return "{}\n{}".format(hashlib.sha256(key.encode()).hexdigest(), os.path.getmtime(ext.cmakelists))
+
+
+def _read_stamp(build_directory: str) -> str:
+    """Read the stamp file from a build directory
+
+    Parameters
+    ----------
+    build_directory : str
+        path to build directory
+
+    Returns
+    -------
+    str
+        contents of the stamp file, or None if it does not exist
+    """
+    try:
+        with open(os.path.join(build_directory, _STAMP_FILE), "r") as f:
+            return f.read()
+    except OSError:
+        return None
 
 
 class CMakeExtension(Extension):
@@ -32,6 +288,9 @@ class CMakeExtension(Extension):
         jobs: int = None,
         include: Callable = None,
         exclude: Callable = None,
+        use_tmpfs: bool = False,
+        include_re: Union[str, Pattern] = None,
+        exclude_re: Union[str, Pattern] = None,
     ):
         """Extension class for CMake builds
 
@@ -49,13 +308,26 @@ class CMakeExtension(Extension):
             to the release directory, by default this is set to `lib`. This means your cmake file should have
             a line like `install(TARGETS some_target LIBRARY DESTINATION lib)`
         jobs : int, optional
-            number of jobs to use during make stage, by default None, which auto-determines the number of jobs
+            number of jobs to use during make stage, by default None, which uses the jobs given with
+            `build_ext -j`, the CMAKE_BUILD_PARALLEL_LEVEL environment variable, or otherwise auto-determines
+            the number of jobs (split between the extensions being built). An explicit value overrides all of these.
         include : Callable, optional
             a callable that takes in a lib name as input and returns a boolean on whether it should be included
             during install
         exclude : Callable, optional
             a callable that takes in a lib name as input and returns a boolean on whether it should be excluded
             during install
+        use_tmpfs : bool, optional
+            build in a temporary directory on a RAM backed filesystem (/dev/shm on Linux) instead of the build
+            directory, by default False. This can also be enabled by setting the CMAKE_SETUPTOOLS_TMPFS
+            environment variable to 1. Falls back to the regular build directory if no tmpfs with enough free space
+            is available. Note that builds in a tmpfs are never incremental.
+        include_re : Union[str, Pattern], optional
+            a regex, a lib is only included during install if the regex matches (re.search) its name. This is
+            faster than an equivalent `include` callable, so prefer it for pure regex filtering
+        exclude_re : Union[str, Pattern], optional
+            a regex, a lib is excluded during install if the regex matches (re.search) its name. This is
+            faster than an equivalent `exclude` callable, so prefer it for pure regex filtering
 
         Raises
         ------
@@ -71,103 +343,250 @@ class CMakeExtension(Extension):
         # Set the library dir
         self.library_dir = library_dir
         # Set the number of build jobs to use
-        self.jobs = jobs if jobs is not None else auto_determine_jobs()
+        self.jobs = jobs
         # Set include/exclude functions
         self.include = include
         self.exclude = exclude
+        # Set include/exclude regexes
+        self.include_re = re.compile(include_re) if include_re is not None else None
+        self.exclude_re = re.compile(exclude_re) if exclude_re is not None else None
+        # Set whether to build in a tmpfs
+        self.use_tmpfs = use_tmpfs
         # We only need to set the name from the Extension class
         # because the sources should be set in the CMakeLists.txt
         Extension.__init__(self, name, sources=[])
 
 
 class CMakeBuild(build_ext):
+    def initialize_options(self):
+        super().initialize_options()
+        # directories already created by this command
+        self._mkdir_cache = set()
+
+    def finalize_options(self):
+        super().finalize_options()
+        # paths computed once and reused across extensions
+        self._build_temp_abs = os.path.abspath(self.build_temp)
+        self._ext_fullpath_cache = dict()
+
     def run(self):
+        if not self.extensions:
+            return
+
         # check if cmake exists, setting 'cmake' as a requires in pyproject.toml
         # should satisfy this check.
-        try:
-            subprocess.run(["cmake", "--version"], check=True)
-        except OSError:
+        self._cmake = shutil.which("cmake")
+        if self._cmake is None:
             raise RuntimeError(
                 "CMake must be installed to build the following extensions: "
                 + ", ".join(e.name for e in self.extensions)
             )
 
-        # always use fresh build directory
-        # this seems to be necessary with editable builds
-        build_directory = os.path.abspath(self.build_temp)
-        shutil.rmtree(build_directory, ignore_errors=True)
-        os.makedirs(build_directory, exist_ok=True)
+        # environment shared by all cmake invocations
+        self._cmake_env = {"CMAKE_COLOR_DIAGNOSTICS": "ON", **os.environ}
+
+        # each extension has its own independent cmake build tree, so build them concurrently,
+        # splitting the available cpus (or the jobs given with build_ext -j or CMAKE_BUILD_PARALLEL_LEVEL)
+        # between the extensions, so that the total number of jobs is bounded
+        parallel = self._parallel_level()
+        total_jobs = parallel or auto_determine_jobs()
+        workers = min(len(self.extensions), total_jobs)
+        auto_jobs = max(total_jobs // workers, 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    self._build_one,
+                    ext,
+                    self._ext_build_directory(ext),
+                    self._ext_jobs(ext, parallel, auto_jobs),
+                )
+                for ext in self.extensions
+            ]
+            for future in futures:
+                future.result()
+
+        # move libs serially since extensions may share a destination directory
+        for ext in self.extensions:
+            self.move_libs(ext)
+
+    def _parallel_level(self):
+        # total number of jobs requested with build_ext -j or CMAKE_BUILD_PARALLEL_LEVEL, if any
+        if self.parallel is True:
+            # build_ext treats parallel=True as "use all cpus"
+            return auto_determine_jobs()
+        if self.parallel:
+            return int(self.parallel)
+        try:
+            return max(int(os.environ["CMAKE_BUILD_PARALLEL_LEVEL"]), 1)
+        except (KeyError, ValueError):
+            return None
+
+    def _ext_jobs(self, ext, parallel, auto_jobs):
+        # an explicit number of jobs on the extension always wins
+        if ext.jobs is not None:
+            return ext.jobs
+        # let cmake interpret a CMAKE_BUILD_PARALLEL_LEVEL that is not a number (e.g. empty)
+        if parallel is None and "CMAKE_BUILD_PARALLEL_LEVEL" in os.environ:
+            return None
+        return auto_jobs
 
-        # TODO: because built_ext allows passing a list of extensions
-        # we should probably loop over the extension list, but cmake can build multiple
-        # extensions, so maybe it should be handled on that end?
+    def _makedirs(self, path):
+        if path not in self._mkdir_cache:
+            os.makedirs(path, exist_ok=True)
+            self._mkdir_cache.add(path)
 
+    def _ext_build_directory(self, ext):
+        return os.path.join(self._build_temp_abs, ext.name)
+
+    def _ext_fullpath(self, ext):
+        if ext.name not in self._ext_fullpath_cache:
+            self._ext_fullpath_cache[ext.name] = self.get_ext_fullpath(ext.name)
+        return self._ext_fullpath_cache[ext.name]
+
+    def _build_one(self, ext, build_directory, jobs):
         # create list of cmake args to pass
         cmake_args = list()
 
         # if toolchain file specified, use the toolchain
-        if self.extensions[0].toolchain:
-            cmake_args += ["--toolchain " + self.extensions[0].toolchain]
+        if ext.toolchain:
+            cmake_args += ["--toolchain", ext.toolchain]
 
         # always set the python executable to the version of the current calling interpreter
         cmake_args += ["-DPYTHON_EXECUTABLE=" + sys.executable]
 
-        # set the install directory
+        # set the install directory, this is always under the build directory in build_temp
         cmake_args += ["-DCMAKE_INSTALL_PREFIX=" + os.path.join(build_directory, "release")]
 
         # get any arguments to add from CMAKE_ARGS environment variable
-        cmake_args += os.environ.get("CMAKE_ARGS", "").split(" ")
-        cmake_args = cmake_args[:-1] if cmake_args[-1] == "" else cmake_args
+        cmake_args += shlex.split(os.environ.get("CMAKE_ARGS", ""))
+
+        # default to a release build if no build type was specified
+        if "CMAKE_BUILD_TYPE" not in os.environ and not _has_cmake_define(cmake_args, "CMAKE_BUILD_TYPE"):
+            cmake_args += ["-DCMAKE_BUILD_TYPE=Release"]
+
+        # prefer ninja if available and no generator was specified, on Windows only inside a
+        # Visual Studio developer environment, otherwise ninja cannot find the compiler
+        if (
+            (os.name != "nt" or "VCINSTALLDIR" in os.environ)
+            and shutil.which("ninja")
+            and "CMAKE_GENERATOR" not in os.environ
+            and not any(arg.startswith("-G") for arg in cmake_args)
+        ):
+            cmake_args += ["-GNinja"]
+
+        # use ccache/sccache as the compiler launcher if available, unless disabled or a launcher was specified
+        compiler_cache = shutil.which("ccache") or shutil.which("sccache")
+        if compiler_cache and not _env_flag("CMAKE_SETUPTOOLS_NO_CCACHE"):
+            for launcher in ["CMAKE_C_COMPILER_LAUNCHER", "CMAKE_CXX_COMPILER_LAUNCHER"]:
+                if launcher not in os.environ and not _has_cmake_define(cmake_args, launcher):
+                    cmake_args += ["-D{}={}".format(launcher, compiler_cache)]
 
         # initialize list for build arguments
         build_args = list()
 
+        # build the install target, so that building and installing is done by a single cmake call
+        build_args = ["--target", "install"]
+
         # set number of jobs to use during build
-        build_args = ["-j{}".format(self.extensions[0].jobs)]
+        if jobs is not None:
+            build_args += ["--parallel", str(jobs)]
 
         # get any arguments to add from CMAKE_BUILD_ARGS environment variable
-        build_args += os.environ.get("CMAKE_BUILD_ARGS", "").split(" ")
-        build_args = build_args[:-1] if build_args[-1] == "" else build_args
+        build_args += shlex.split(os.environ.get("CMAKE_BUILD_ARGS", ""))
 
-        # CMakeLists.txt is in the same directory as this setup.py file
-        subprocess.run(
-            ["cmake", os.path.dirname(self.extensions[0].cmakelists)] + cmake_args, cwd=build_directory, check=True
-        )
+        # always start from an empty install prefix, so libraries from earlier builds are not shipped again
+        _fast_rmtree(os.path.join(build_directory, "release"))
+
+        # build in a tmpfs if requested, the libraries are still installed to the release directory in build_temp
+        if ext.use_tmpfs or _env_flag("CMAKE_SETUPTOOLS_TMPFS"):
+            tmpfs_directory = _make_tmpfs_directory()
+            if tmpfs_directory is not None:
+                try:
+                    self._run_cmake(ext, tmpfs_directory, cmake_args, build_args)
+                finally:
+                    _fast_rmtree(tmpfs_directory)
+                return
 
-        # build the C++ libraries
-        cmake_cmd = ["cmake", "--build", "."] + build_args
-        subprocess.run(cmake_cmd, cwd=build_directory, check=True)
+        # reuse the existing build directory so cmake can do an incremental rebuild,
+        # unless a clean build is forced (--force or CMAKE_SETUPTOOLS_CLEAN)
+        stamp = _build_stamp(ext, cmake_args)
+        previous_stamp = _read_stamp(build_directory)
+        if self.force or _env_flag("CMAKE_SETUPTOOLS_CLEAN"):
+            _fast_rmtree(build_directory)
+            self._mkdir_cache.discard(build_directory)
+        elif previous_stamp is None or previous_stamp.split("\n")[0] != stamp.split("\n")[0]:
+            # the configuration changed, so the cmake cache is stale
+            try:
+                os.remove(os.path.join(build_directory, "CMakeCache.txt"))
+            except FileNotFoundError:
+                pass
+            _fast_rmtree(os.path.join(build_directory, "CMakeFiles"))
+        self._makedirs(build_directory)
+
+        # skip the configure step if the cache is still valid, the build tool reruns it if needed
+        configure = previous_stamp != stamp or not os.path.exists(os.path.join(build_directory, "CMakeCache.txt"))
+        self._run_cmake(ext, build_directory, cmake_args, build_args, configure)
 
-        # install the C++ libraries
-        subprocess.run(["cmake", "--install", "."], cwd=build_directory, check=True)
-        self.move_libs(self.extensions[0])
+        # record the configuration of this build for the next invocation
+        with open(os.path.join(build_directory, _STAMP_FILE), "w") as f:
+            f.write(stamp)
+
+    def _run_cmake(self, ext, build_directory, cmake_args, build_args, configure=True):
+        # CMakeLists.txt is in the same directory as this setup.py file
+        if configure:
+            subprocess.run(
+                [self._cmake, os.path.dirname(ext.cmakelists)] + cmake_args,
+                cwd=build_directory,
+                env=self._cmake_env,
+                check=True,
+            )
+
+        # build and install the C++ libraries
+        cmake_cmd = [self._cmake, "--build", "."] + build_args
+        subprocess.run(cmake_cmd, cwd=build_directory, env=self._cmake_env, check=True)
 
     def move_libs(self, ext):
         print("Moving libraries to specified module path...")
         # setup directory names
-        build_temp = os.path.abspath(self.build_temp)
-        dest_ext = self.get_ext_fullpath(ext.name)
-        source_dir = os.path.join(build_temp, "release", ext.library_dir)
+        dest_ext = self._ext_fullpath(ext)
+        source_dir = os.path.join(self._ext_build_directory(ext), "release", ext.library_dir)
         dest_dir = os.path.dirname(dest_ext)
-        os.makedirs(dest_dir, exist_ok=True)
+        self._makedirs(dest_dir)
 
-        # make __init__.py if it doesn't exist
-        if not os.path.exists(os.path.join(dest_dir, "__init__.py")):
-            with open(os.path.join(dest_dir, "__init__.py"), "w"):
+        # make __init__.py if it doesn't exist, leaving an existing one (and its mtime) untouched
+        init_path = os.path.join(dest_dir, "__init__.py")
+        if not os.path.exists(init_path):
+            with open(init_path, "w"):
                 pass
 
         # move libs to destination path
-        for f in glob.glob(os.path.join(source_dir, "*.so*")):
-            f = os.path.basename(f)
-            source_path = os.path.join(source_dir, f)
-            dest_path = os.path.join(dest_dir, f)
-            # we filter libraries by include if specified
-            if ext.include is not None:
-                if not ext.include(f):
+        if not os.path.isdir(source_dir):
+            return
+        # bind the include/exclude filters once, defaulting to including everything
+        include = ext.include if ext.include is not None else _include_all
+        exclude = ext.exclude if ext.exclude is not None else _exclude_none
+        include_re = ext.include_re.search if ext.include_re is not None else _include_all
+        exclude_re = ext.exclude_re.search if ext.exclude_re is not None else _exclude_none
+        dest_prefix = os.path.join(dest_dir, "")
+        libs = dict()
+        with os.scandir(source_dir) as it:
+            for entry in it:
+                # skip directories and hidden files
+                if entry.is_dir(follow_symlinks=False) or entry.name.startswith("."):
                     continue
-            # we filter libraries by exclude if specified
-            if ext.exclude is not None:
-                if ext.exclude(f):
+                f = entry.name
+                # only shared libraries (including versioned sonames, e.g. lib.so.1)
+                if ".so" not in f:
+                    continue
+                # we filter libraries by include/exclude (regexes first), else we select the library for copying
+                if include_re(f) and not exclude_re(f) and include(f) and not exclude(f):
+                    libs[f] = entry
+
+        # copy the selected libs, keeping symlinks (e.g. versioned sonames) that point at another selected lib
+        for f, entry in libs.items():
+            dest_path = dest_prefix + f
+            if entry.is_symlink():
+                target = os.readlink(entry.path)
+                if target in libs and _copy_symlink(target, dest_path):
                     continue
-            # else we copy the file from source_path to dest_path
-            self.copy_file(source_path, dest_path)
+            _fast_link(entry.path, dest_path)
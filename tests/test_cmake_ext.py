@@ -0,0 +1,357 @@
+import os
+
+import pytest
+from setuptools import Distribution
+
+from cmake_setuptools_ext import CMakeExtension, CMakeBuild, auto_determine_jobs
+from cmake_setuptools_ext import cmake_ext
+
+
+@pytest.fixture
+def cmakelists(tmp_path):
+    path = tmp_path / "src" / "CMakeLists.txt"
+    path.parent.mkdir()
+    path.write_text("project(test)\n")
+    return str(path)
+
+
+def make_command(tmp_path, ext):
+    cmd = CMakeBuild(Distribution({"ext_modules": [ext]}))
+    cmd.initialize_options()
+    cmd.build_lib = str(tmp_path / "build" / "lib")
+    cmd.build_temp = str(tmp_path / "build" / "temp")
+    cmd.finalize_options()
+    return cmd
+
+
+def make_libs(cmd, ext, files=(), symlinks=()):
+    lib_dir = os.path.join(cmd._ext_build_directory(ext), "release", ext.library_dir)
+    os.makedirs(lib_dir)
+    for name in files:
+        with open(os.path.join(lib_dir, name), "w") as f:
+            f.write(name)
+    for name, target in symlinks:
+        os.symlink(target, os.path.join(lib_dir, name))
+
+
+def dest_dir(cmd, ext):
+    return os.path.dirname(cmd.get_ext_fullpath(ext.name))
+
+
+sonames = dict(
+    files=["libfoo.so.1.2.3"],
+    symlinks=[("libfoo.so.1", "libfoo.so.1.2.3"), ("libfoo.so", "libfoo.so.1")],
+)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="requires symlinks")
+def test_move_libs_keeps_soname_symlinks(tmp_path, cmakelists):
+    ext = CMakeExtension("pkg.libs.ext", cmakelists)
+    cmd = make_command(tmp_path, ext)
+    make_libs(cmd, ext, **sonames)
+    cmd.move_libs(ext)
+    dest = dest_dir(cmd, ext)
+    assert sorted(os.listdir(dest)) == ["__init__.py", "libfoo.so", "libfoo.so.1", "libfoo.so.1.2.3"]
+    assert not os.path.islink(os.path.join(dest, "libfoo.so.1.2.3"))
+    assert os.readlink(os.path.join(dest, "libfoo.so.1")) == "libfoo.so.1.2.3"
+    assert os.readlink(os.path.join(dest, "libfoo.so")) == "libfoo.so.1"
+    # moving again over the existing libs works
+    cmd.move_libs(ext)
+    assert os.readlink(os.path.join(dest, "libfoo.so")) == "libfoo.so.1"
+
+
+@pytest.mark.skipif(os.name == "nt", reason="requires symlinks")
+def test_move_libs_copies_symlink_with_unselected_target(tmp_path, cmakelists):
+    ext = CMakeExtension("pkg.libs.ext", cmakelists, exclude_re=r"\.so\.1\.2\.3$")
+    cmd = make_command(tmp_path, ext)
+    make_libs(cmd, ext, **sonames)
+    cmd.move_libs(ext)
+    dest = dest_dir(cmd, ext)
+    assert sorted(os.listdir(dest)) == ["__init__.py", "libfoo.so", "libfoo.so.1"]
+    # the target was not selected, so the contents are copied instead of a dangling symlink
+    assert not os.path.islink(os.path.join(dest, "libfoo.so.1"))
+    with open(os.path.join(dest, "libfoo.so.1")) as f:
+        assert f.read() == "libfoo.so.1.2.3"
+    assert os.readlink(os.path.join(dest, "libfoo.so")) == "libfoo.so.1"
+
+
+@pytest.mark.parametrize(
+    "kwargs, expected",
+    [
+        (dict(), ["liba.so", "libb.so", "libc.so", "libd.so.1"]),
+        (dict(include_re=r"lib[abc]"), ["liba.so", "libb.so", "libc.so"]),
+        (dict(include_re=r"lib[abc]", exclude=lambda n: n == "libb.so"), ["liba.so", "libc.so"]),
+        (dict(include=lambda n: n != "liba.so", exclude_re=r"\.so\.1$"), ["libb.so", "libc.so"]),
+        (dict(include_re=r"lib[ab]", include=lambda n: n == "libb.so"), ["libb.so"]),
+        (dict(exclude_re=r"libc", exclude=lambda n: n.startswith("libd")), ["liba.so", "libb.so"]),
+    ],
+)
+def test_move_libs_filters(tmp_path, cmakelists, kwargs, expected):
+    ext = CMakeExtension("pkg.libs.ext", cmakelists, **kwargs)
+    cmd = make_command(tmp_path, ext)
+    make_libs(cmd, ext, files=["liba.so", "libb.so", "libc.so", "libd.so.1", "libe.a", ".hidden.so"])
+    cmd.move_libs(ext)
+    assert sorted(os.listdir(dest_dir(cmd, ext))) == ["__init__.py"] + expected
+
+
+def test_build_stamp(tmp_path, cmakelists, monkeypatch):
+    monkeypatch.delenv("CC", raising=False)
+    ext = CMakeExtension("pkg.libs.ext", cmakelists)
+    stamp = cmake_ext._build_stamp(ext, ["-DA=1"])
+    assert cmake_ext._build_stamp(ext, ["-DA=1"]) == stamp
+    # changing the arguments or the environment changes the configuration part of the stamp
+    assert cmake_ext._build_stamp(ext, ["-DA=2"]).split("\n")[0] != stamp.split("\n")[0]
+    monkeypatch.setenv("CC", "clang")
+    assert cmake_ext._build_stamp(ext, ["-DA=1"]).split("\n")[0] != stamp.split("\n")[0]
+    monkeypatch.delenv("CC")
+    # changing the CMakeLists.txt only changes its modification time part of the stamp
+    mtime = os.path.getmtime(cmakelists)
+    os.utime(cmakelists, (mtime + 10, mtime + 10))
+    new_stamp = cmake_ext._build_stamp(ext, ["-DA=1"])
+    assert new_stamp != stamp
+    assert new_stamp.split("\n")[0] == stamp.split("\n")[0]
+
+
+def test_read_stamp(tmp_path):
+    assert cmake_ext._read_stamp(str(tmp_path)) is None
+    (tmp_path / cmake_ext._STAMP_FILE).write_text("stamp")
+    assert cmake_ext._read_stamp(str(tmp_path)) == "stamp"
+
+
+def test_build_one_skips_configure_with_valid_stamp(tmp_path, cmakelists, monkeypatch):
+    for var in ["CC", "CMAKE_SETUPTOOLS_CLEAN", "CMAKE_SETUPTOOLS_TMPFS", "CMAKE_ARGS"]:
+        monkeypatch.delenv(var, raising=False)
+    ext = CMakeExtension("pkg.libs.ext", cmakelists)
+    cmd = make_command(tmp_path, ext)
+    build_directory = cmd._ext_build_directory(ext)
+    configured = list()
+
+    def run_cmake(ext, build_directory, cmake_args, build_args, configure=True):
+        configured.append(configure)
+        with open(os.path.join(build_directory, "CMakeCache.txt"), "a"):
+            pass
+
+    monkeypatch.setattr(cmd, "_run_cmake", run_cmake)
+    cmd._build_one(ext, build_directory, 1)
+    cmd._build_one(ext, build_directory, 1)
+    # a configuration change reconfigures with a fresh cache
+    monkeypatch.setenv("CC", "clang")
+    cmd._build_one(ext, build_directory, 1)
+    assert configured == [True, False, True]
+    # as does a missing cache
+    os.remove(os.path.join(build_directory, "CMakeCache.txt"))
+    cmd._build_one(ext, build_directory, 1)
+    assert configured == [True, False, True, True]
+
+
+@pytest.mark.parametrize(
+    "cpu_max, expected",
+    [
+        ("max 100000\n", 8),
+        ("200000 100000\n", 2),
+        ("50000 100000\n", 1),
+        ("1600000 100000\n", 8),
+        (None, 8),
+    ],
+)
+def test_auto_determine_jobs_cgroup(tmp_path, monkeypatch, cpu_max, expected):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+    path = tmp_path / "cpu.max"
+    if cpu_max is not None:
+        path.write_text(cpu_max)
+    monkeypatch.setattr(cmake_ext, "_CGROUP_CPU_MAX", str(path))
+    assert auto_determine_jobs() == expected
+
+
+def test_fast_rmtree(tmp_path, monkeypatch):
+    tree = tmp_path / "R&D" / "build"
+    (tree / "sub").mkdir(parents=True)
+    (tree / "sub" / "file").write_text("file")
+    cmake_ext._fast_rmtree(str(tree))
+    assert not tree.exists()
+    assert (tmp_path / "R&D").exists()
+    # a missing path does not spawn a process
+    monkeypatch.setattr(cmake_ext.subprocess, "run", None)
+    cmake_ext._fast_rmtree(str(tree))
+
+
+def failing_link(src, dst):
+    raise OSError("link not supported")
+
+
+@pytest.mark.parametrize("copy_file_range", ["native", "short", "missing"])
+def test_fast_link_copy_fallback(tmp_path, monkeypatch, copy_file_range):
+    src = tmp_path / "libfoo.so"
+    dst = tmp_path / "dest" / "libfoo.so"
+    dst.parent.mkdir()
+    src.write_bytes(os.urandom(100000))
+    os.chmod(str(src), 0o750)
+    monkeypatch.setattr(os, "link", failing_link)
+    if copy_file_range == "short":
+        monkeypatch.setattr(os, "copy_file_range", lambda *args: 0, raising=False)
+    elif copy_file_range == "missing":
+        monkeypatch.delattr(os, "copy_file_range", raising=False)
+    cmake_ext._fast_link(str(src), str(dst))
+    assert dst.read_bytes() == src.read_bytes()
+    assert os.stat(str(dst)).st_mode == os.stat(str(src)).st_mode
+
+
+@pytest.mark.parametrize(
+    "parallel, level, ext_jobs, expected_workers, expected_jobs",
+    [
+        (None, None, None, 4, [2, 2, 2, 2]),
+        (1, None, None, 1, [1, 1, 1, 1]),
+        (8, None, None, 4, [2, 2, 2, 2]),
+        (16, None, None, 4, [4, 4, 4, 4]),
+        (True, None, None, 4, [2, 2, 2, 2]),
+        (None, "2", None, 2, [1, 1, 1, 1]),
+        (None, "", None, 4, [None, None, None, None]),
+        (3, "2", None, 3, [1, 1, 1, 1]),
+        (None, None, 5, 4, [5, 2, 2, 2]),
+        (1, None, 5, 1, [5, 1, 1, 1]),
+    ],
+)
+def test_run_job_budget(tmp_path, cmakelists, monkeypatch, parallel, level, ext_jobs, expected_workers, expected_jobs):
+    monkeypatch.setattr(cmake_ext, "auto_determine_jobs", lambda: 8)
+    monkeypatch.setattr(cmake_ext.shutil, "which", lambda name: "/usr/bin/" + name)
+    if level is None:
+        monkeypatch.delenv("CMAKE_BUILD_PARALLEL_LEVEL", raising=False)
+    else:
+        monkeypatch.setenv("CMAKE_BUILD_PARALLEL_LEVEL", level)
+    workers = list()
+
+    class Executor(cmake_ext.ThreadPoolExecutor):
+        def __init__(self, max_workers):
+            workers.append(max_workers)
+            super().__init__(max_workers=max_workers)
+
+    monkeypatch.setattr(cmake_ext, "ThreadPoolExecutor", Executor)
+    exts = [CMakeExtension("pkg.ext{}".format(i), cmakelists) for i in range(4)]
+    exts[0].jobs = ext_jobs
+    cmd = CMakeBuild(Distribution({"ext_modules": exts}))
+    cmd.initialize_options()
+    cmd.build_temp = str(tmp_path / "build" / "temp")
+    cmd.parallel = parallel
+    cmd.finalize_options()
+    jobs = dict()
+    monkeypatch.setattr(cmd, "_build_one", lambda ext, build_directory, ext_jobs: jobs.update({ext.name: ext_jobs}))
+    monkeypatch.setattr(cmd, "move_libs", lambda ext: None)
+    cmd.run()
+    assert workers == [expected_workers]
+    assert [jobs[ext.name] for ext in exts] == expected_jobs
+
+
+def cmake_arguments(tmp_path, ext, monkeypatch):
+    # run _build_one without cmake, returning the configure and build arguments
+    monkeypatch.delenv("CMAKE_SETUPTOOLS_TMPFS", raising=False)
+    cmd = make_command(tmp_path, ext)
+    args = dict()
+
+    def run_cmake(ext, build_directory, cmake_args, build_args, configure=True):
+        args.update(cmake_args=cmake_args, build_args=build_args)
+
+    monkeypatch.setattr(cmd, "_run_cmake", run_cmake)
+    cmd._build_one(ext, cmd._ext_build_directory(ext), 1)
+    return args["cmake_args"], args["build_args"]
+
+
+def test_build_one_parses_cmake_args(tmp_path, cmakelists, monkeypatch):
+    monkeypatch.setenv("CMAKE_ARGS", '-DCMAKE_CXX_FLAGS="-O3 -march=native"  -DFOO=1 ')
+    monkeypatch.setenv("CMAKE_BUILD_ARGS", "--verbose")
+    toolchain = tmp_path / "my toolchain.cmake"
+    toolchain.write_text("")
+    ext = CMakeExtension("pkg.libs.ext", cmakelists, toolchain=str(toolchain))
+    cmake_args, build_args = cmake_arguments(tmp_path, ext, monkeypatch)
+    assert cmake_args[:2] == ["--toolchain", str(toolchain)]
+    assert "-DCMAKE_CXX_FLAGS=-O3 -march=native" in cmake_args
+    assert "-DFOO=1" in cmake_args
+    assert "" not in cmake_args
+    assert build_args[-1] == "--verbose"
+
+
+def test_build_one_empty_cmake_args(tmp_path, cmakelists, monkeypatch):
+    monkeypatch.setenv("CMAKE_ARGS", "")
+    monkeypatch.delenv("CMAKE_BUILD_ARGS", raising=False)
+    cmake_args, build_args = cmake_arguments(tmp_path, CMakeExtension("pkg.libs.ext", cmakelists), monkeypatch)
+    assert "" not in cmake_args
+    assert "" not in build_args
+
+
+@pytest.mark.parametrize(
+    "cmake_args, expected",
+    [
+        (["-DCMAKE_BUILD_TYPE=Debug"], True),
+        (["-D", "CMAKE_BUILD_TYPE=Debug"], True),
+        (["-DCMAKE_BUILD_TYPE:STRING=Debug"], True),
+        (["-D", "CMAKE_BUILD_TYPE:STRING=Debug"], True),
+        (["-DCMAKE_BUILD_TYPE"], True),
+        (["-DCMAKE_BUILD_TYPES=Debug"], False),
+        (["-D", "CMAKE_BUILD_TYPES=Debug"], False),
+        (["-DOTHER=CMAKE_BUILD_TYPE"], False),
+        (["CMAKE_BUILD_TYPE=Debug"], False),
+        (["-D"], False),
+        ([], False),
+    ],
+)
+def test_has_cmake_define(cmake_args, expected):
+    assert cmake_ext._has_cmake_define(cmake_args, "CMAKE_BUILD_TYPE") == expected
+
+
+@pytest.mark.parametrize(
+    "cmake_args_env, expected",
+    [
+        ("", "-DCMAKE_BUILD_TYPE=Release"),
+        ("-D CMAKE_BUILD_TYPE=Debug", None),
+        ("-DCMAKE_BUILD_TYPE:STRING=Debug", None),
+    ],
+)
+def test_build_one_default_build_type(tmp_path, cmakelists, monkeypatch, cmake_args_env, expected):
+    monkeypatch.delenv("CMAKE_BUILD_TYPE", raising=False)
+    monkeypatch.setenv("CMAKE_ARGS", cmake_args_env)
+    cmake_args, _ = cmake_arguments(tmp_path, CMakeExtension("pkg.libs.ext", cmakelists), monkeypatch)
+    assert ("-DCMAKE_BUILD_TYPE=Release" in cmake_args) == (expected is not None)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, False),
+        ("", False),
+        ("0", False),
+        ("false", False),
+        ("no", False),
+        ("off", False),
+        ("1", True),
+        ("true", True),
+        ("Yes", True),
+        (" ON ", True),
+    ],
+)
+def test_env_flag(monkeypatch, value, expected):
+    if value is None:
+        monkeypatch.delenv("CMAKE_SETUPTOOLS_TEST_FLAG", raising=False)
+    else:
+        monkeypatch.setenv("CMAKE_SETUPTOOLS_TEST_FLAG", value)
+    assert cmake_ext._env_flag("CMAKE_SETUPTOOLS_TEST_FLAG") == expected
+
+
+@pytest.mark.parametrize(
+    "env, expected",
+    [
+        (dict(), ["C", "CXX"]),
+        (dict(CMAKE_SETUPTOOLS_NO_CCACHE="0"), ["C", "CXX"]),
+        (dict(CMAKE_SETUPTOOLS_NO_CCACHE="1"), []),
+        (dict(CMAKE_ARGS="-D CMAKE_C_COMPILER_LAUNCHER=distcc"), ["CXX"]),
+        (dict(CMAKE_ARGS="-DCMAKE_CXX_COMPILER_LAUNCHER:FILEPATH=distcc"), ["C"]),
+        (dict(CMAKE_C_COMPILER_LAUNCHER="distcc"), ["CXX"]),
+    ],
+)
+def test_build_one_compiler_launcher(tmp_path, cmakelists, monkeypatch, env, expected):
+    for var in ["CMAKE_ARGS", "CMAKE_SETUPTOOLS_NO_CCACHE", "CMAKE_C_COMPILER_LAUNCHER", "CMAKE_CXX_COMPILER_LAUNCHER"]:
+        monkeypatch.delenv(var, raising=False)
+    for var, value in env.items():
+        monkeypatch.setenv(var, value)
+    monkeypatch.setattr(cmake_ext.shutil, "which", lambda name: "/usr/bin/ccache" if name == "ccache" else None)
+    cmake_args, _ = cmake_arguments(tmp_path, CMakeExtension("pkg.libs.ext", cmakelists), monkeypatch)
+    launchers = [arg for arg in cmake_args if arg.endswith("_COMPILER_LAUNCHER=/usr/bin/ccache")]
+    assert launchers == ["-DCMAKE_{}_COMPILER_LAUNCHER=/usr/bin/ccache".format(lang) for lang in expected]